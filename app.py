@@ -1,7 +1,8 @@
 import os
+import asyncio
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Dict, Any
 import json
@@ -15,11 +16,14 @@ load_dotenv()
 
 app = FastAPI(title="Research Assistant MVP", version="1.0.0")
 
-# Global variables to hold our data
-vector_store = None
-rag_graph = None
-pdf_ingestion = None
-current_pdf_path = None
+# Per-process state for the currently loaded PDF
+app.state.vector_store = None
+app.state.rag_graph = None
+app.state.pdf_ingestion = None
+app.state.current_pdf_path = None
+
+# Read size used when streaming uploads to disk
+UPLOAD_CHUNK_SIZE = 1 << 20
 
 class QuestionRequest(BaseModel):
     question: str
@@ -33,30 +37,46 @@ class QuestionResponse(BaseModel):
 @app.post("/upload")
 async def upload_pdf(file: UploadFile = File(...)):
     """Upload and process a PDF file"""
-    global vector_store, rag_graph, pdf_ingestion, current_pdf_path
-    
     if not file.filename.endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
     
+    vector_store = None
     try:
         # Save uploaded file
         upload_dir = "uploads"
         os.makedirs(upload_dir, exist_ok=True)
         
         file_path = os.path.join(upload_dir, file.filename)
-        current_pdf_path = file_path
         
+        # Stream the upload to disk in 1 MiB chunks to bound memory use, with
+        # writes in a worker thread so they don't block the event loop
         with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await asyncio.to_thread(buffer.write, chunk)
+        
+        # Process the PDF with small-to-big chunking (50/250 tokens, ~200/~1000
+        # chars), keeping blocking work off the event loop
+        pdf_ingestion = await asyncio.to_thread(PDFIngestion)
+        documents, embeddings = await pdf_ingestion.aload_split_embed(file_path)
+        vector_store = await asyncio.to_thread(pdf_ingestion.create_vector_store, documents, embeddings)
+        
+        # Initialize RAG graph with the parent chunks the child hits point to
+        rag_graph = await asyncio.to_thread(RAGGraph, vector_store, pdf_ingestion.parent_documents)
         
-        # Process the PDF with optimized chunking
-        pdf_ingestion = PDFIngestion(chunk_size=400, chunk_overlap=100)
-        documents = pdf_ingestion.load_and_split(file_path)
-        vector_store = pdf_ingestion.create_vector_store(documents)
+        # Publish the new state only once processing has succeeded
+        previous_store = app.state.vector_store
+        previous_graph = app.state.rag_graph
+        app.state.current_pdf_path = file_path
+        app.state.pdf_ingestion = pdf_ingestion
+        app.state.vector_store = vector_store
+        app.state.rag_graph = rag_graph
         
-        # Initialize RAG graph with documents
-        rag_graph = RAGGraph(vector_store, documents)
+        # Drop the replaced graph's answer cache and chunk collection so they
+        # don't leak; the graph waits for questions still using them to finish
+        if previous_graph is not None:
+            previous_graph.close(delete_vector_store=True)
+        elif previous_store is not None:
+            previous_store.delete_collection()
         
         return {
             "message": "PDF uploaded and processed successfully",
@@ -65,19 +85,25 @@ async def upload_pdf(file: UploadFile = File(...)):
         }
     
     except Exception as e:
+        # Don't leak the new chunk collection if the graph couldn't be built
+        if vector_store is not None and vector_store is not app.state.vector_store:
+            vector_store.delete_collection()
         raise HTTPException(status_code=500, detail=f"Error processing PDF: {str(e)}")
 
 @app.post("/qa", response_model=QuestionResponse)
 async def ask_question(request: QuestionRequest):
     """Ask a question about the uploaded PDF"""
-    global rag_graph
+    rag_graph = app.state.rag_graph
     
     if not rag_graph:
         raise HTTPException(status_code=400, detail="No PDF has been uploaded yet")
     
+    # Keep the graph's collections alive while the question runs, even if a
+    # new upload replaces it in the meantime
+    rag_graph.acquire()
     try:
-        # Process the question through RAG graph
-        result = rag_graph.process_question(request.question, request.session_notes)
+        # Process the question through RAG graph without blocking the event loop
+        result = await asyncio.to_thread(rag_graph.process_question, request.question, request.session_notes)
         
         return QuestionResponse(
             answer=result["answer"],
@@ -87,6 +113,41 @@ async def ask_question(request: QuestionRequest):
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing question: {str(e)}")
+    finally:
+        rag_graph.release()
+
+@app.post("/qa/stream")
+async def ask_question_stream(request: QuestionRequest):
+    """Ask a question about the uploaded PDF, streaming the answer as it is generated
+    
+    The response is newline-delimited JSON: one object with the sources and
+    page references, followed by objects carrying pieces of the answer.
+    """
+    rag_graph = app.state.rag_graph
+    
+    if not rag_graph:
+        raise HTTPException(status_code=400, detail="No PDF has been uploaded yet")
+    
+    # Keep the graph's collections alive until the answer has been streamed
+    rag_graph.acquire()
+    try:
+        # Retrieval runs up front so errors can still be reported as a status code
+        references, answer_stream = await asyncio.to_thread(
+            rag_graph.stream_question, request.question, request.session_notes
+        )
+    except Exception as e:
+        rag_graph.release()
+        raise HTTPException(status_code=500, detail=f"Error processing question: {str(e)}")
+    
+    def generate():
+        try:
+            yield json.dumps(references) + "\n"
+            for piece in answer_stream:
+                yield json.dumps({"answer": piece}) + "\n"
+        finally:
+            rag_graph.release()
+    
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
 
 @app.get("/pdf/{filename}")
 async def serve_pdf(filename: str):
@@ -100,14 +161,14 @@ async def serve_pdf(filename: str):
 @app.get("/status")
 async def get_status():
     """Get current system status"""
-    global rag_graph, vector_store, pdf_ingestion, current_pdf_path
+    state = app.state
     
     return {
-        "rag_graph_loaded": rag_graph is not None,
-        "vector_store_loaded": vector_store is not None,
-        "pdf_ingestion_loaded": pdf_ingestion is not None,
-        "current_pdf": current_pdf_path,
-        "total_documents": len(rag_graph.all_documents) if rag_graph else 0
+        "rag_graph_loaded": state.rag_graph is not None,
+        "vector_store_loaded": state.vector_store is not None,
+        "pdf_ingestion_loaded": state.pdf_ingestion is not None,
+        "current_pdf": state.current_pdf_path,
+        "total_documents": len(state.rag_graph.all_documents) if state.rag_graph else 0
     }
 
 # Mount static files for frontend
@@ -129,4 +190,5 @@ async def serve_js():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # A single worker, since the loaded PDF lives in this process's app.state
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools")
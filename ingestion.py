@@ -1,16 +1,51 @@
 import os
-from typing import List, Dict, Any
+import uuid
+import asyncio
+import threading
+import hashlib
+import sqlite3
+from functools import lru_cache
+from typing import List, Dict, Any, Iterator, Tuple, Optional
 from langchain_community.document_loaders import PyPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import Chroma
 from langchain.schema import Document
 from sentence_transformers import SentenceTransformer
+from transformers import AutoTokenizer, PreTrainedTokenizerBase
 import numpy as np
+import torch
+
+# WordPiece tokenizer shared by all-MiniLM-L6-v2 and nomic-embed-text (both use
+# the bert-base-uncased vocabulary), used to measure chunks in model tokens
+TOKENIZER_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Rough characters per token, used to size chunks when the tokenizer is unavailable
+CHARS_PER_TOKEN = 4
+
+@lru_cache(maxsize=1)
+def get_tokenizer() -> Optional[PreTrainedTokenizerBase]:
+    """Load the chunking tokenizer once per process, or None if it can't be loaded"""
+    try:
+        # Prefer the local cache so offline deployments don't wait on the hub
+        return AutoTokenizer.from_pretrained(TOKENIZER_NAME, local_files_only=True)
+    except Exception:
+        pass
+    try:
+        return AutoTokenizer.from_pretrained(TOKENIZER_NAME)
+    except Exception as e:
+        print(f"Warning: tokenizer {TOKENIZER_NAME} not available, measuring chunks in characters. Error: {e}")
+        return None
 
 class OllamaEmbeddings:
     """Custom embedding class using local models"""
     
-    def __init__(self, model_name: str = "nomic-embed-text"):
+    def __init__(self, model_name: str = "nomic-embed-text", batch_size: int = 64,
+                 cache_path: str = "embedding_cache.sqlite3", cache_max_entries: int = 100_000):
+        self.batch_size = batch_size
+        self.cache_path = cache_path
+        # At about 1.6 KB per 768-dim fp16 vector, the default caps the cache near 160 MB
+        self.cache_max_entries = cache_max_entries
+        
         # Initialize the local embedding model
         # Note: This uses SentenceTransformers as a fallback if Ollama embeddings aren't directly available
         try:
@@ -21,7 +56,7 @@ class OllamaEmbeddings:
             
             # Test if the model is available
             try:
-                self.client.embeddings(model=model_name, prompt="test")
+                self.client.embed(model=model_name, input="test")
             except Exception:
                 print(f"Warning: Ollama model {model_name} not available, falling back to SentenceTransformers")
                 self.use_ollama = False
@@ -31,101 +66,372 @@ class OllamaEmbeddings:
         if not self.use_ollama:
             # Fallback to a similar model via SentenceTransformers
             self.model = SentenceTransformer('all-MiniLM-L6-v2')
+            
+            # Run in reduced precision where the hardware supports it
+            if torch.cuda.is_available():
+                self.model = self.model.half()
+            elif self._cpu_supports_bf16():
+                self.model = self.model.to(torch.bfloat16)
+        
+        # Cached vectors are only valid for the model that produced them
+        self.model_id = self.model_name if self.use_ollama else 'all-MiniLM-L6-v2'
+        
+        # Content-addressed embedding cache shared across uploads. The cache is
+        # best-effort: if it can't be opened, embeddings are computed without it
+        try:
+            conn = sqlite3.connect(self.cache_path, timeout=5)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, embedding BLOB NOT NULL)")
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"Warning: embedding cache {self.cache_path} not available, embedding without it. Error: {e}")
+            self.cache_path = None
+    
+    @staticmethod
+    def _cpu_supports_bf16() -> bool:
+        """Check whether the CPU has native bfloat16 instructions (AVX512-BF16 or AMX)
+        
+        oneDNN's own bf16 check also passes on plain AVX-512 CPUs, where bf16
+        is emulated and slower than fp32, so the instruction sets are checked directly.
+        """
+        try:
+            return torch.cpu._is_avx512_bf16_supported() or torch.cpu._is_amx_tile_supported()
+        except Exception:
+            return False
+    
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        """Encode texts with the SentenceTransformer model into unit-length float32 vectors"""
+        # SentenceTransformer.encode already length-sorts its batches
+        embeddings = self.model.encode(
+            texts,
+            batch_size=self.batch_size,
+            convert_to_tensor=True,
+            show_progress_bar=False
+        )
+        
+        # Upcast before normalizing to avoid half-precision accumulation error
+        embeddings = torch.nn.functional.normalize(embeddings.float(), p=2, dim=1)
+        return embeddings.cpu().numpy()
+    
+    def _cache_key(self, text: str) -> bytes:
+        """Hash a text together with the model id into an embedding cache key"""
+        return hashlib.blake2b(f"{self.model_id}\0{text}".encode('utf-8'), digest_size=16).digest()
     
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        """Embed a list of documents"""
+        """Embed a list of documents, reusing cached vectors for texts seen before"""
+        keys = [self._cache_key(text) for text in texts]
+        cached = self._cache_get(list(set(keys)))
+        
+        # Embed only the misses, once per distinct text
+        misses = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                misses.setdefault(key, text)
+        if misses:
+            miss_embeddings = self._embed_uncached(list(misses.values()))
+            # Vectors are stored as fp16 to halve the cache size
+            new_rows = [
+                (key, np.asarray(embedding, dtype=np.float16).tobytes())
+                for key, embedding in zip(misses, miss_embeddings)
+            ]
+            self._cache_put(new_rows)
+            cached.update(new_rows)
+        
+        return [np.frombuffer(cached[key], dtype=np.float16).astype(np.float32).tolist() for key in keys]
+    
+    def _cache_get(self, keys: List[bytes]) -> Dict[bytes, bytes]:
+        """Look up cached fp16 vectors by key, returning nothing if the cache fails"""
+        if self.cache_path is None:
+            return {}
+        
+        cached = {}
+        try:
+            conn = sqlite3.connect(self.cache_path, timeout=5)
+            try:
+                # Stay under SQLite's bound-variable limit
+                for start in range(0, len(keys), 500):
+                    batch = keys[start:start + 500]
+                    rows = conn.execute(
+                        f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                        batch
+                    )
+                    cached.update(rows)
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"Warning: embedding cache lookup failed, embedding without it. Error: {e}")
+            return {}
+        return cached
+    
+    def _cache_put(self, rows: List[Tuple[bytes, bytes]]) -> None:
+        """Store fp16 vectors, dropping the oldest entries beyond cache_max_entries"""
+        if self.cache_path is None:
+            return
+        
+        try:
+            conn = sqlite3.connect(self.cache_path, timeout=5)
+            try:
+                with conn:
+                    conn.executemany("INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)", rows)
+                    # Inserts get increasing rowids, so everything more than
+                    # cache_max_entries rows behind the newest one is the oldest;
+                    # SQLite reuses the freed pages, which bounds the file size
+                    conn.execute(
+                        "DELETE FROM embeddings WHERE rowid <= (SELECT MAX(rowid) FROM embeddings) - ?",
+                        (self.cache_max_entries,)
+                    )
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"Warning: embedding cache write failed. Error: {e}")
+    
+    def _embed_uncached(self, texts: List[str]) -> List[List[float]]:
+        """Embed a list of documents with the underlying model"""
         if self.use_ollama:
+            # Send texts in batches so each request embeds many chunks at once
             embeddings = []
-            for text in texts:
-                response = self.client.embeddings(model=self.model_name, prompt=text)
-                embeddings.append(response['embedding'])
+            for start in range(0, len(texts), self.batch_size):
+                batch = texts[start:start + self.batch_size]
+                response = self.client.embed(model=self.model_name, input=batch)
+                embeddings.extend(response['embeddings'])
             return embeddings
         else:
-            return self.model.encode(texts).tolist()
+            return self._encode(texts).tolist()
     
     def embed_query(self, text: str) -> List[float]:
         """Embed a single query"""
         if self.use_ollama:
-            response = self.client.embeddings(model=self.model_name, prompt=text)
-            return response['embedding']
+            response = self.client.embed(model=self.model_name, input=text)
+            return response['embeddings'][0]
         else:
-            return self.model.encode([text])[0].tolist()
+            return self._encode([text])[0].tolist()
 
 class PDFIngestion:
-    """Handles PDF loading, chunking, and vector store creation"""
+    """Handles PDF loading, chunking, and vector store creation
+    
+    Pages are split into parent chunks that are handed to the LLM, and each
+    parent is split again into small child chunks that are embedded and
+    searched. Children carry their parent's ``parent_id`` in metadata.
+    """
     
-    def __init__(self, chunk_size: int = 600, chunk_overlap: int = 150):
+    def __init__(self, chunk_size: int = 50, chunk_overlap: int = 10, parent_chunk_size: int = 250):
+        # Chunk sizes are in embedding-model tokens (50/250 is about 200/1000
+        # characters), so children stay well inside the embedder's input window
+        if chunk_size <= 0:
+            raise ValueError(f"chunk_size must be positive, got {chunk_size}")
+        if not 0 <= chunk_overlap < chunk_size:
+            raise ValueError(f"chunk_overlap must be at least 0 and less than chunk_size ({chunk_size}), got {chunk_overlap}")
+        if chunk_size >= parent_chunk_size:
+            raise ValueError(f"chunk_size ({chunk_size}) must be smaller than parent_chunk_size ({parent_chunk_size})")
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            length_function=len,
-            separators=["\n\n", "\n", ". ", " ", ""]
-        )
+        self.parent_chunk_size = parent_chunk_size
+        self.text_splitter = self._make_splitter(chunk_size, chunk_overlap)
+        # Parents don't overlap, so no text is repeated in the LLM context
+        self.parent_splitter = self._make_splitter(parent_chunk_size, 0)
+        
+        # Parent chunks of the most recently split PDF
+        self.parent_documents: List[Document] = []
         
         # Initialize local embeddings
         self.embeddings = OllamaEmbeddings("nomic-embed-text")
     
-    def load_and_split(self, pdf_path: str) -> List[Document]:
-        """Load PDF and split into chunks"""
+    @staticmethod
+    def _make_splitter(chunk_size: int, chunk_overlap: int) -> RecursiveCharacterTextSplitter:
+        """Build a splitter measuring token counts, or approximate characters without a tokenizer"""
+        separators = ["\n\n", "\n", ". ", " ", ""]
+        tokenizer = get_tokenizer()
         
-        # Load PDF using PyPDFLoader
+        if tokenizer is None:
+            return RecursiveCharacterTextSplitter(
+                chunk_size=chunk_size * CHARS_PER_TOKEN,
+                chunk_overlap=chunk_overlap * CHARS_PER_TOKEN,
+                length_function=len,
+                separators=separators
+            )
+        
+        return RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+            tokenizer,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            separators=separators
+        )
+    
+    def iter_chunks(self, pdf_path: str) -> Iterator[Document]:
+        """Stream child chunks from a PDF one page at a time
+        
+        Parent chunks are collected into ``self.parent_documents`` as the
+        stream advances.
+        """
+        
+        # Load pages lazily so only one page is held before splitting
         loader = PyPDFLoader(pdf_path)
-        pages = loader.load()
+        self.parent_documents = []
+        chunk_id = 0
         
-        # Add page numbers and enhance metadata
-        enhanced_docs = []
-        for i, page in enumerate(pages):
+        for i, page in enumerate(loader.lazy_load()):
             # Add page number to metadata
             page.metadata.update({
                 "page": i + 1,
                 "source": pdf_path,
                 "chunk_type": "page"
             })
-            enhanced_docs.append(page)
+            
+            # Split the page into parent chunks for the LLM context
+            for parent in self.parent_splitter.split_documents([page]):
+                parent_id = len(self.parent_documents)
+                parent.metadata.update({
+                    "chunk_type": "parent",
+                    "chunk_id": parent_id,
+                    "parent_id": parent_id
+                })
+                
+                # Extract paragraph info for better citation
+                first_line = next((line.strip() for line in parent.page_content.split('\n') if line.strip()), None)
+                if first_line:
+                    parent.metadata["first_line"] = first_line[:100]
+                
+                self.parent_documents.append(parent)
+                
+                # Split the parent into small child chunks for retrieval
+                for doc in self.text_splitter.split_documents([parent]):
+                    doc.metadata.update({
+                        "chunk_type": "child",
+                        "chunk_id": chunk_id
+                    })
+                    chunk_id += 1
+                    yield doc
+    
+    def load_and_split(self, pdf_path: str) -> List[Document]:
+        """Load PDF and split into child chunks"""
+        documents = list(self.iter_chunks(pdf_path))
+        self._set_total_chunks(documents)
+        self._set_total_chunks(self.parent_documents)
+        return documents
+    
+    async def aload_split_embed(self, pdf_path: str, batch_size: int = 32,
+                                max_concurrency: int = 2) -> Tuple[List[Document], List[List[float]]]:
+        """Load, split and embed a PDF without blocking the event loop
         
-        # Split documents into smaller chunks
-        documents = self.text_splitter.split_documents(enhanced_docs)
+        A worker thread streams chunks into a bounded queue in batches while
+        up to ``max_concurrency`` batches are embedded in worker threads, so
+        splitting the next pages overlaps with waiting on the embedding model
+        without flooding the shared thread pool.
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=4)
+        stop = threading.Event()
+        semaphore = asyncio.Semaphore(max_concurrency)
         
-        # Enhance chunk metadata
-        for i, doc in enumerate(documents):
-            doc.metadata.update({
-                "chunk_id": i,
-                "total_chunks": len(documents)
-            })
+        def produce() -> None:
+            batch = []
+            try:
+                for doc in self.iter_chunks(pdf_path):
+                    if stop.is_set():
+                        return
+                    batch.append(doc)
+                    if len(batch) == batch_size:
+                        asyncio.run_coroutine_threadsafe(queue.put(batch), loop).result()
+                        batch = []
+                if batch:
+                    asyncio.run_coroutine_threadsafe(queue.put(batch), loop).result()
+            finally:
+                # Always signal the end so the consumer cannot hang on errors
+                asyncio.run_coroutine_threadsafe(queue.put(None), loop).result()
+        
+        async def embed(batch: List[Document]) -> List[List[float]]:
+            async with semaphore:
+                return await asyncio.to_thread(self.embeddings.embed_documents, [doc.page_content for doc in batch])
+        
+        producer = asyncio.create_task(asyncio.to_thread(produce))
+        
+        documents = []
+        embed_tasks = []
+        try:
+            while (batch := await queue.get()) is not None:
+                documents.extend(batch)
+                embed_tasks.append(asyncio.create_task(embed(batch)))
             
-            # Extract paragraph info for better citation
-            content_lines = doc.page_content.split('\n')
-            non_empty_lines = [line.strip() for line in content_lines if line.strip()]
-            if non_empty_lines:
-                doc.metadata["first_line"] = non_empty_lines[0][:100]
+            # Surface producer errors before waiting on the embeddings
+            await producer
+            batch_embeddings = await asyncio.gather(*embed_tasks)
+        finally:
+            # On failure, stop the producer and cancel outstanding batches;
+            # the queue is drained so a producer blocked on put can exit
+            stop.set()
+            for task in embed_tasks:
+                task.cancel()
+            while not producer.done():
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.wait({producer}, timeout=0.05)
+            await asyncio.gather(producer, *embed_tasks, return_exceptions=True)
         
-        return documents
+        self._set_total_chunks(documents)
+        self._set_total_chunks(self.parent_documents)
+        embeddings = [embedding for batch in batch_embeddings for embedding in batch]
+        return documents, embeddings
+    
+    @staticmethod
+    def _set_total_chunks(documents: List[Document]) -> None:
+        """Record the chunk total, which is only known once the whole PDF has been streamed"""
+        for doc in documents:
+            doc.metadata["total_chunks"] = len(documents)
     
-    def create_vector_store(self, documents: List[Document]) -> Chroma:
-        """Create vector store from documents"""
+    def create_vector_store(self, documents: List[Document], embeddings: List[List[float]] = None) -> Chroma:
+        """Create vector store from documents, reusing precomputed embeddings if given"""
+        texts = [doc.page_content for doc in documents]
+        
+        # Embed everything in one batched call when no embeddings were passed
+        if embeddings is None:
+            embeddings = self.embeddings.embed_documents(texts)
+        
+        # In-memory Chroma collections are shared process-wide, so each PDF gets
+        # its own collection; otherwise chunks from earlier uploads stay searchable
+        collection_name = f"pdf_{uuid.uuid4().hex}"
         
-        # Create Chroma vector store with local embeddings
-        vector_store = Chroma.from_documents(
-            documents=documents,
-            embedding=self.embeddings,
+        # Insert the vectors directly rather than through from_documents so
+        # nothing is embedded twice and LangChain's per-document wrapping is skipped
+        vector_store = Chroma(
+            collection_name=collection_name,
+            embedding_function=self.embeddings,
             persist_directory=None  # In-memory store
         )
+        ids = [str(uuid.uuid4()) for _ in documents]
+        metadatas = [doc.metadata for doc in documents]
+        
+        # Chroma rejects inserts larger than its maximum batch size
+        max_batch_size = vector_store._client.get_max_batch_size()
+        try:
+            for start in range(0, len(documents), max_batch_size):
+                end = start + max_batch_size
+                vector_store._collection.add(
+                    ids=ids[start:end],
+                    embeddings=embeddings[start:end],
+                    documents=texts[start:end],
+                    metadatas=metadatas[start:end]
+                )
+        except Exception:
+            # Don't leave a half-filled collection behind
+            vector_store.delete_collection()
+            raise
         
         return vector_store
     
     def extract_text_metadata(self, text: str, page_num: int) -> Dict[str, Any]:
         """Extract useful metadata from text content"""
         
-        lines = text.split('\n')
-        paragraphs = [p.strip() for p in text.split('\n\n') if p.strip()]
-        
+        # map() keeps the per-character checks in C while matching
+        # str.isdigit/str.isupper exactly (including superscript digits), and
+        # the line list is never materialized just to count it
         return {
-            "line_count": len(lines),
-            "paragraph_count": len(paragraphs),
+            "line_count": text.count('\n') + 1,
+            "paragraph_count": sum(1 for p in text.split('\n\n') if p.strip()),
             "char_count": len(text),
             "word_count": len(text.split()),
-            "has_numbers": any(char.isdigit() for char in text),
-            "has_uppercase": any(char.isupper() for char in text)
+            "has_numbers": any(map(str.isdigit, text)),
+            "has_uppercase": any(map(str.isupper, text))
         }
@@ -1,21 +1,45 @@
 import os
-from typing import List, Dict, Any
+import re
+import json
+import uuid
+import threading
+from collections import OrderedDict, Counter
+from typing import List, Dict, Any, Iterator, Tuple
 from langchain.chains import RetrievalQA
 from langchain.prompts import PromptTemplate
 from langchain_community.vectorstores import Chroma
 from langchain.schema import Document
 import ollama
 
+# Matches page-specific queries such as "page 3" or "p. 3"
+_PAGE_RE = re.compile(r'\b(?:page|p\.?)\s*(\d+)\b')
+
+# Matches every citation marker in one scan: numbered references [1] through
+# [49] and the keywords typical of bibliography entries
+_CITATION_MARKERS_RE = re.compile(
+    r'(?P<ref>\[(?:[1-9]|[1-4]\d)\])|(?P<arxiv>arxiv)|(?P<proceedings>proceedings)|(?P<et_al>et al)',
+    re.IGNORECASE
+)
+
 class OllamaLLM:
     """Custom LLM wrapper for Ollama"""
     
-    def __init__(self, model_name: str = "gemma2:2b"):
+    def __init__(self, model_name: str = "gemma2:2b", keep_alive: str = "30m", num_ctx: int = 4096):
         self.client = ollama.Client()
         self.model_name = model_name
         
+        # Keep the model resident between questions so calls don't pay a reload
+        self.keep_alive = keep_alive
+        self.options = {"num_ctx": num_ctx}
+        
         # Test if the model is available
         try:
-            self.client.chat(model=model_name, messages=[{"role": "user", "content": "test"}])
+            self.client.chat(
+                model=model_name,
+                messages=[{"role": "user", "content": "test"}],
+                keep_alive=self.keep_alive,
+                options=self.options
+            )
         except Exception as e:
             raise ValueError(f"Ollama model {model_name} not available. Error: {e}")
     
@@ -24,31 +48,82 @@ class OllamaLLM:
         try:
             response = self.client.chat(
                 model=self.model_name,
-                messages=[{"role": "user", "content": prompt}]
+                messages=[{"role": "user", "content": prompt}],
+                keep_alive=self.keep_alive,
+                options=self.options
             )
             return response['message']['content']
         except Exception as e:
             return f"Error generating response: {e}"
     
+    def stream(self, prompt: str) -> Iterator[str]:
+        """Generate a response for the given prompt, yielding text as it is decoded
+        
+        Unlike predict, errors are raised to the caller.
+        """
+        for part in self.client.chat(
+            model=self.model_name,
+            messages=[{"role": "user", "content": prompt}],
+            stream=True,
+            keep_alive=self.keep_alive,
+            options=self.options
+        ):
+            yield part['message']['content']
+    
     def __call__(self, prompt: str) -> str:
         return self.predict(prompt)
 
 class RAGGraph:
     """Handles the RAG (Retrieval-Augmented Generation) pipeline"""
     
-    def __init__(self, vector_store: Chroma, documents: List[Document] = None, model_name: str = "gemma2:2b"):
+    def __init__(self, vector_store: Chroma, documents: List[Document] = None, model_name: str = "gemma2:2b",
+                 cache_size: int = 512, cache_threshold: float = 0.92):
         self.vector_store = vector_store
-        self.retriever = vector_store.as_retriever(
-            search_type="similarity",
-            search_kwargs={"k": 15}  # Retrieve more chunks for better filtering
-        )
+        self.search_k = 6  # Small child chunks are precise, so few hits are needed
         
-        # Store all documents for page-specific queries
+        # Store all (parent) documents for page-specific queries
         self.all_documents = documents or []
         
-        # Initialize Ollama chat model
+        # Parent lookup for child chunks returned by the vector store
+        self._parents: Dict[int, Document] = {
+            doc.metadata['parent_id']: doc for doc in self.all_documents if 'parent_id' in doc.metadata
+        }
+        
+        # Index documents by page, in chunk order, for O(1) page lookups
+        self._by_page: Dict[int, List[Document]] = {}
+        for doc in self.all_documents:
+            self._by_page.setdefault(doc.metadata.get('page'), []).append(doc)
+        for page_docs in self._by_page.values():
+            page_docs.sort(key=lambda x: x.metadata.get('chunk_id', 0))
+        
+        # Semantic answer cache: previous questions live in their own Chroma
+        # collection so lookups use the HNSW index; cache ids are kept in
+        # least-recently-used order for eviction once full. A cache_size of 0
+        # or less disables the cache
+        self.cache_size = cache_size
+        self.cache_threshold = cache_threshold
+        
+        # Initialize Ollama chat model first, so a missing model fails before
+        # any collection is created that would then leak
         self.llm = OllamaLLM(model_name)
         
+        self.cache_store = Chroma(
+            collection_name=f"qa_cache_{uuid.uuid4().hex}",
+            embedding_function=vector_store.embeddings,
+            collection_metadata={"hnsw:space": "cosine"}
+        )
+        self._cache_ids = OrderedDict()
+        # Questions are answered from worker threads, so guard the LRU order
+        self._cache_lock = threading.Lock()
+        
+        # Questions still running against this graph; close() defers deleting
+        # the collections until they have all finished
+        self._active = 0
+        self._closing = False
+        self._closed = False
+        self._delete_vector_store = False
+        self._active_lock = threading.Lock()
+        
         # Create custom prompt template
         self.qa_template = """You are an expert research assistant analyzing the "Attention Is All You Need" paper. Your goal is to provide clear, accurate, and comprehensive answers based solely on the provided context.
 
@@ -71,10 +146,78 @@ Previous session notes (if any):
 Question: {question}
 
 Detailed Answer:"""
+        
+        # Split the template around its placeholders once, so building a
+        # prompt is plain concatenation instead of a format parse per question
+        self._prompt_prefix, rest = self.qa_template.split("{context}")
+        self._prompt_before_notes, rest = rest.split("{session_notes}")
+        self._prompt_before_question, self._prompt_suffix = rest.split("{question}")
     
     def process_question(self, question: str, session_notes: List[Dict[str, Any]] = None) -> Dict[str, Any]:
         """Process a question through the RAG pipeline"""
         
+        # Answers depend on the notes, so only cache note-free questions
+        q_emb = None
+        if not session_notes and self.cache_size > 0:
+            q_emb = self._embed_question(question)
+            cached = self._cache_lookup(question, q_emb)
+            if cached is not None:
+                return cached
+        
+        full_prompt, sources, page_references = self._prepare_question(question, session_notes)
+        
+        # Generate response using Ollama
+        answer = self.llm.predict(full_prompt)
+        
+        result = {
+            "answer": answer,
+            "sources": sources,
+            "page_references": page_references
+        }
+        
+        if q_emb is not None and not answer.startswith("Error generating response"):
+            self._cache_add(question, q_emb, result)
+        
+        return result
+    
+    def stream_question(self, question: str, session_notes: List[Dict[str, Any]] = None) -> Tuple[Dict[str, Any], Iterator[str]]:
+        """Process a question through the RAG pipeline, streaming the answer
+        
+        Returns the sources and page references, which are known before
+        generation starts, and an iterator over pieces of the answer.
+        """
+        
+        # Answers depend on the notes, so only cache note-free questions
+        q_emb = None
+        if not session_notes and self.cache_size > 0:
+            q_emb = self._embed_question(question)
+            cached = self._cache_lookup(question, q_emb)
+            if cached is not None:
+                references = {"sources": cached["sources"], "page_references": cached["page_references"]}
+                return references, iter([cached["answer"]])
+        
+        full_prompt, sources, page_references = self._prepare_question(question, session_notes)
+        references = {"sources": sources, "page_references": page_references}
+        
+        def generate() -> Iterator[str]:
+            pieces = []
+            try:
+                for piece in self.llm.stream(full_prompt):
+                    pieces.append(piece)
+                    yield piece
+            except Exception as e:
+                yield f"Error generating response: {e}"
+                return
+            
+            # Cache only once the full answer has been generated
+            if q_emb is not None:
+                self._cache_add(question, q_emb, {"answer": "".join(pieces), **references})
+        
+        return references, generate()
+    
+    def _prepare_question(self, question: str, session_notes: List[Dict[str, Any]] = None) -> Tuple[str, List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """Retrieve context for a question and build its prompt, sources and page references"""
+        
         # Format session notes for context
         notes_context = ""
         if session_notes:
@@ -93,107 +236,219 @@ Detailed Answer:"""
             content = doc.page_content.strip()
             context += f"[Document {i} - Page {page_num}]\n{content}\n\n"
         
-        # Build the full prompt
-        full_prompt = self.qa_template.format(
-            context=context,
-            session_notes=notes_context,
-            question=question
-        )
-        
-        # Generate response using Ollama
-        answer = self.llm.predict(full_prompt)
+        # Build the full prompt from the pre-split template
+        full_prompt = "".join((
+            self._prompt_prefix, context,
+            self._prompt_before_notes, notes_context,
+            self._prompt_before_question, question,
+            self._prompt_suffix
+        ))
         
         # Extract source documents and create page references
         sources = []
         page_references = []
+        seen_pages = set()
         
         for doc in docs:
             metadata = doc.metadata
             page_num = metadata.get("page", 1)
+            content = doc.page_content
+            preview_long = content[:200] + "..." if len(content) > 200 else content
             
             source_info = {
-                "content": doc.page_content[:200] + "..." if len(doc.page_content) > 200 else doc.page_content,
+                "content": preview_long,
                 "page": page_num,
                 "chunk_id": metadata.get("chunk_id", 0),
                 "first_line": metadata.get("first_line", "")
             }
             sources.append(source_info)
             
-            # Create clickable page reference
-            page_ref = {
-                "page": page_num,
-                "text": f"p.{page_num}",
-                "preview": doc.page_content[:100] + "..." if len(doc.page_content) > 100 else doc.page_content
-            }
-            
-            # Avoid duplicate page references
-            if not any(ref["page"] == page_num for ref in page_references):
-                page_references.append(page_ref)
+            # Create clickable page reference, avoiding duplicate pages
+            if page_num not in seen_pages:
+                seen_pages.add(page_num)
+                page_references.append({
+                    "page": page_num,
+                    "text": f"p.{page_num}",
+                    "preview": content[:100] + "..." if len(content) > 100 else content
+                })
         
         # Sort page references by page number
         page_references.sort(key=lambda x: x["page"])
         
-        return {
-            "answer": answer,
-            "sources": sources,
-            "page_references": page_references
-        }
+        return full_prompt, sources, page_references
+    
+    def acquire(self) -> None:
+        """Mark a question as in progress, so close() waits for it before deleting collections"""
+        with self._active_lock:
+            self._active += 1
+    
+    def release(self) -> None:
+        """Mark a question started with acquire() as finished"""
+        with self._active_lock:
+            self._active -= 1
+            delete = self._closing and self._active == 0 and not self._closed
+            if delete:
+                self._closed = True
+        if delete:
+            self._delete_collections()
+    
+    def close(self, delete_vector_store: bool = False) -> None:
+        """Delete the answer cache collection, which would otherwise outlive this graph
+        
+        Deletion waits until every acquired question has been released. With
+        ``delete_vector_store`` the chunk collection is deleted along with it.
+        """
+        with self._active_lock:
+            self._closing = True
+            self._delete_vector_store = delete_vector_store
+            delete = self._active == 0 and not self._closed
+            if delete:
+                self._closed = True
+        if delete:
+            self._delete_collections()
+    
+    def _delete_collections(self) -> None:
+        """Delete the collections released by close()"""
+        self.cache_store.delete_collection()
+        with self._cache_lock:
+            self._cache_ids.clear()
+        if self._delete_vector_store:
+            self.vector_store.delete_collection()
+    
+    def _embed_question(self, question: str) -> List[float]:
+        """Embed a question for cache lookups, or None if embedding fails"""
+        try:
+            return self.vector_store.embeddings.embed_query(question)
+        except Exception as e:
+            print(f"Warning: skipping answer cache, question could not be embedded. Error: {e}")
+            return None
+    
+    def _cache_lookup(self, question: str, q_emb: List[float]) -> Dict[str, Any]:
+        """Return a cached response for a paraphrase of a previous question, if any"""
+        if q_emb is None or not self._cache_ids:
+            return None
+        
+        # "page 3" and "page 4" embed almost identically, so the pages must match too
+        pages = json.dumps(_PAGE_RE.findall(question.lower()))
+        try:
+            results = self.cache_store._collection.query(
+                query_embeddings=[q_emb],
+                n_results=1,
+                where={"pages": pages},
+                include=["metadatas", "distances"]
+            )
+        except Exception as e:
+            # The cache is only an optimization, so never fail the question over it
+            print(f"Warning: answer cache lookup failed. Error: {e}")
+            return None
+        if not results["ids"][0]:
+            return None
+        
+        # Cosine distance is 1 - cosine similarity
+        if 1 - results["distances"][0][0] < self.cache_threshold:
+            return None
+        
+        cache_id = results["ids"][0][0]
+        with self._cache_lock:
+            # The entry may have been evicted by another thread since the query
+            if cache_id not in self._cache_ids:
+                return None
+            self._cache_ids.move_to_end(cache_id)
+        return json.loads(results["metadatas"][0][0]["result"])
+    
+    def _cache_add(self, question: str, q_emb: List[float], result: Dict[str, Any]) -> None:
+        """Store a response in the semantic cache, evicting the least recently used entry when full"""
+        cache_id = uuid.uuid4().hex
+        with self._cache_lock:
+            evicted_id = None
+            if len(self._cache_ids) >= self.cache_size:
+                evicted_id, _ = self._cache_ids.popitem(last=False)
+            self._cache_ids[cache_id] = None
         
+        try:
+            if evicted_id is not None:
+                self.cache_store._collection.delete(ids=[evicted_id])
+            
+            # Reuse the lookup embedding rather than embedding the question again
+            self.cache_store._collection.add(
+                ids=[cache_id],
+                embeddings=[q_emb],
+                documents=[question],
+                metadatas=[{
+                    "pages": json.dumps(_PAGE_RE.findall(question.lower())),
+                    "result": json.dumps(result)
+                }]
+            )
+        except Exception as e:
+            # The cache is only an optimization, so never fail the question over it
+            print(f"Warning: answer cache insert failed. Error: {e}")
+            with self._cache_lock:
+                self._cache_ids.pop(cache_id, None)
+        
+    def _search(self, query: str, filter: Dict[str, Any] = None) -> List[Document]:
+        """Search child chunks and return their parent chunks, deduplicated in hit order"""
+        children = self.vector_store.similarity_search(query, k=self.search_k, filter=filter)
+        
+        docs = []
+        seen_parents = set()
+        for child in children:
+            parent_id = child.metadata.get('parent_id')
+            if parent_id in seen_parents:
+                continue
+            seen_parents.add(parent_id)
+            # Fall back to the child itself when its parent isn't cached
+            docs.append(self._parents.get(parent_id, child))
+        
+        return docs
+    
     def _retrieve_documents(self, question: str) -> List[Document]:
         """Retrieve documents based on question type"""
-        import re
+        question_lower = question.lower()
         
         # Check for page-specific queries
-        page_pattern = r'\b(?:page|p\.?)\s*(\d+)\b'
-        page_matches = re.findall(page_pattern, question.lower())
+        page_matches = _PAGE_RE.findall(question_lower)
         
         if page_matches:
             # This is a page-specific query
-            target_pages = [int(page) for page in page_matches]
+            target_pages = sorted({int(page) for page in page_matches})
             
-            # Filter cached documents by page number
-            page_docs = []
-            for doc in self.all_documents:
-                if doc.metadata.get('page') in target_pages:
-                    page_docs.append(doc)
-            
-            # Sort by chunk_id to maintain order
-            page_docs.sort(key=lambda x: x.metadata.get('chunk_id', 0))
+            # Look up cached documents by page number; pages are visited in
+            # ascending order so chunk order is preserved across pages
+            page_docs = [doc for page in target_pages for doc in self._by_page.get(page, [])]
             
             if page_docs:
                 return page_docs
-            else:
-                # Fallback: semantic search with original query
-                return self.retriever.invoke(question)
+            
+            # Fallback: let Chroma filter by page when documents weren't cached,
+            # then plain semantic search with the original query
+            return (
+                self._search(question, filter={"page": {"$in": target_pages}})
+                or self._search(question)
+            )
         else:
             # Normal semantic search with enhanced query processing and content filtering
             enhanced_query = question
             
             # For general questions about the paper, enhance with key terms
-            if any(term in question.lower() for term in ['what is this paper', 'paper about', 'abstract', 'summary', 'summarize']):
+            if any(term in question_lower for term in ['what is this paper', 'paper about', 'abstract', 'summary', 'summarize']):
                 enhanced_query = f"{question} transformer attention mechanism neural network architecture model"
             
             # Get initial results
-            raw_docs = self.retriever.invoke(enhanced_query)
+            raw_docs = self._search(enhanced_query)
             
             # Filter out citation-heavy chunks for general queries
             filtered_docs = []
             citation_docs = []
             
             for doc in raw_docs:
-                content = doc.page_content.lower()
-                
-                # Count citation indicators
-                citation_indicators = [
-                    content.count('[' + str(i) + ']') for i in range(1, 50)
-                ]
-                total_citations = sum(citation_indicators)
+                # Count all citation markers in a single scan
+                markers = Counter(match.lastgroup for match in _CITATION_MARKERS_RE.finditer(doc.page_content))
                 
                 # Check if this is primarily citations
                 is_citation_heavy = (
-                    total_citations > 3 or  # Many numbered references
-                    ('arxiv' in content and 'proceedings' in content) or  # Typical citation format
-                    (content.count('et al') > 2)  # Many author references
+                    markers['ref'] > 3 or  # Many numbered references
+                    (markers['arxiv'] and markers['proceedings']) or  # Typical citation format
+                    markers['et_al'] > 2  # Many author references
                 )
                 
                 if is_citation_heavy:
@@ -202,7 +457,7 @@ Detailed Answer:"""
                     filtered_docs.append(doc)
             
             # For general queries, prefer content over citations
-            if filtered_docs and any(term in question.lower() for term in ['summary', 'summarize', 'what is', 'paper about', 'abstract']):
+            if filtered_docs and any(term in question_lower for term in ['summary', 'summarize', 'what is', 'paper about', 'abstract']):
                 # Prioritize early pages (1-3) for summaries and overviews
                 early_page_docs = [doc for doc in filtered_docs if doc.metadata.get('page', 1) <= 3]
                 other_docs = [doc for doc in filtered_docs if doc.metadata.get('page', 1) > 3]